@@ -13,21 +13,21 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import itertools
 import logging
 
-from six import iteritems
-
 from twisted.internet import defer
 from twisted.python.failure import Failure
 
 from synapse.api.constants import EventTypes, Membership
 from synapse.api.errors import SynapseError
-from synapse.logging.context import run_in_background
+from synapse.logging.context import make_deferred_yieldable, run_in_background
 from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.storage.state import StateFilter
 from synapse.types import RoomStreamToken
+from synapse.util import unwrapFirstError
 from synapse.util.async_helpers import ReadWriteLock
-from synapse.util.stringutils import random_string
+from synapse.util.caches.expiringcache import ExpiringCache
 from synapse.visibility import filter_events_for_client
 
 logger = logging.getLogger(__name__)
@@ -75,12 +75,20 @@ class PaginationHandler(object):
         self.storage = hs.get_storage()
         self.state_store = self.storage.state
         self.clock = hs.get_clock()
+        self._secrets = hs.get_secrets()
         self._server_name = hs.hostname
 
         self.pagination_lock = ReadWriteLock()
         self._purges_in_progress_by_room = set()
-        # map from purge id to PurgeStatus
+        # map from purge id to PurgeStatus, for purges which haven't completed yet
         self._purges_by_id = {}
+        # map from purge id to PurgeStatus, for purges which have completed. These
+        # are kept around for 24 hours after they complete.
+        self._completed_purges_by_id = ExpiringCache(
+            cache_name="completed_purges_by_id",
+            clock=self.clock,
+            expiry_ms=24 * 3600 * 1000,
+        )
         self._event_serializer = hs.get_event_client_serializer()
 
         self._retention_default_max_lifetime = hs.config.retention_default_max_lifetime
@@ -88,17 +96,51 @@ class PaginationHandler(object):
         if hs.config.retention_enabled:
             # Run the purge jobs described in the configuration file.
             for job in hs.config.retention_purge_jobs:
+                min_ms = job["shortest_max_lifetime"]
+                max_ms = job["longest_max_lifetime"]
+
                 self.clock.looping_call(
                     run_as_background_process,
                     job["interval"],
                     "purge_history_for_rooms_in_range",
                     self.purge_history_for_rooms_in_range,
-                    job["shortest_max_lifetime"],
-                    job["longest_max_lifetime"],
+                    min_ms,
+                    max_ms,
+                    self._should_include_null(min_ms, max_ms),
                 )
 
-    @defer.inlineCallbacks
-    def purge_history_for_rooms_in_range(self, min_ms, max_ms):
+    def _should_include_null(self, min_ms, max_ms):
+        """Works out whether a purge job for the given retention range should also
+        target rooms which don't have a retention policy.
+
+        This only depends on the server's configuration, so is computed once per
+        purge job rather than every time the job runs.
+
+        Args:
+            min_ms (int|None): Lower limit of the range (exclusive), or None.
+            max_ms (int|None): Upper limit of the range (inclusive), or None.
+
+        Returns:
+            bool
+        """
+        # We want the storage layer to to include rooms with no retention policy in its
+        # return value only if a default retention policy is defined in the server's
+        # configuration and that policy's 'max_lifetime' is either lower (or equal) than
+        # max_ms or higher than min_ms (or both).
+        if self._retention_default_max_lifetime is None:
+            return False
+
+        if min_ms is not None and min_ms >= self._retention_default_max_lifetime:
+            # The default max_lifetime is lower than (or equal to) min_ms.
+            return False
+
+        if max_ms is not None and max_ms < self._retention_default_max_lifetime:
+            # The default max_lifetime is higher than max_ms.
+            return False
+
+        return True
+
+    async def purge_history_for_rooms_in_range(self, min_ms, max_ms, include_null):
         """Purge outdated events from rooms within the given retention range.
 
         If a default retention policy is defined in the server's configuration and its
@@ -112,29 +154,21 @@ class PaginationHandler(object):
             max_ms (int|None): Duration in milliseconds that define the upper limit of
                 the range to handle (inclusive). If None, it means that the range has no
                 upper limit.
+            include_null (bool): Whether to also target rooms which don't have a
+                retention policy, as computed by `_should_include_null`.
         """
-        # We want the storage layer to to include rooms with no retention policy in its
-        # return value only if a default retention policy is defined in the server's
-        # configuration and that policy's 'max_lifetime' is either lower (or equal) than
-        # max_ms or higher than min_ms (or both).
-        if self._retention_default_max_lifetime is not None:
-            include_null = True
-
-            if min_ms is not None and min_ms >= self._retention_default_max_lifetime:
-                # The default max_lifetime is lower than (or equal to) min_ms.
-                include_null = False
-
-            if max_ms is not None and max_ms < self._retention_default_max_lifetime:
-                # The default max_lifetime is higher than max_ms.
-                include_null = False
-        else:
-            include_null = False
-
-        rooms = yield self.store.get_rooms_for_retention_period_in_range(
+        rooms = await self.store.get_rooms_for_retention_period_in_range(
             min_ms, max_ms, include_null
         )
 
-        for room_id, retention_policy in iteritems(rooms):
+        if not rooms:
+            return
+
+        # Figure out, for each room, the timestamp before which events should be
+        # purged. All rooms in this sweep share the same notion of "now".
+        now = self.clock.time_msec()
+        ts_by_room = {}
+        for room_id, retention_policy in rooms.items():
             if room_id in self._purges_in_progress_by_room:
                 logger.warning(
                     "[purge] not purging room %s as there's an ongoing purge running"
@@ -151,32 +185,46 @@ class PaginationHandler(object):
                 # in the server's configuration.
                 max_lifetime = self._retention_default_max_lifetime
 
-            # Figure out what token we should start purging at.
-            ts = self.clock.time_msec() - max_lifetime
+            ts_by_room[room_id] = now - max_lifetime
 
-            stream_ordering = yield self.store.find_first_stream_ordering_after_ts(ts)
+        if not ts_by_room:
+            return
 
-            r = yield self.store.get_room_event_after_stream_ordering(
-                room_id, stream_ordering,
-            )
+        # Look up the tokens we should start purging at for all of the rooms at
+        # once, rather than doing two database round-trips per room.
+        stream_orderings = await self.store.find_first_stream_orderings_after_ts(
+            ts_by_room.values()
+        )
+
+        events = await self.store.get_room_events_after_stream_orderings(
+            (room_id, stream_orderings[ts]) for room_id, ts in ts_by_room.items()
+        )
+
+        for room_id, ts in ts_by_room.items():
+            # A purge may have started for this room while we were looking up
+            # the tokens, in which case it'll take care of the room.
+            if room_id in self._purges_in_progress_by_room:
+                continue
+
+            r = events.get(room_id)
             if not r:
                 logger.warning(
                     "[purge] purging events not possible: No event found "
                     "(ts %i => stream_ordering %i)",
                     ts,
-                    stream_ordering,
+                    stream_orderings[ts],
                 )
                 continue
 
             (stream, topo, _event_id) = r
             token = "t%d-%d" % (topo, stream)
 
-            purge_id = random_string(16)
+            purge_id = self._secrets.token_hex(8)
 
             self._purges_by_id[purge_id] = PurgeStatus()
 
             logger.info(
-                "Starting purging events in room %s (purge_id %s)" % (room_id, purge_id)
+                "Starting purging events in room %s (purge_id %s)", room_id, purge_id
             )
 
             # We want to purge everything, including local events, and to run the purge in
@@ -204,7 +252,7 @@ class PaginationHandler(object):
                 400, "History purge already in progress for %s" % (room_id,)
             )
 
-        purge_id = random_string(16)
+        purge_id = self._secrets.token_hex(8)
 
         # we log the purge_id here so that it can be tied back to the
         # request id in the log lines.
@@ -216,8 +264,7 @@ class PaginationHandler(object):
         )
         return purge_id
 
-    @defer.inlineCallbacks
-    def _purge_history(self, purge_id, room_id, token, delete_local_events):
+    async def _purge_history(self, purge_id, room_id, token, delete_local_events):
         """Carry out a history purge on a room.
 
         Args:
@@ -226,32 +273,30 @@ class PaginationHandler(object):
             token (str): topological token to delete events before
             delete_local_events (bool): True to delete local events as well as
                 remote ones
-
-        Returns:
-            Deferred
         """
+        purge_status = self._purges_by_id[purge_id]
+
         self._purges_in_progress_by_room.add(room_id)
         try:
-            with (yield self.pagination_lock.write(room_id)):
-                yield self.storage.purge_events.purge_history(
+            async with self.pagination_lock.write(room_id):
+                await self.storage.purge_events.purge_history(
                     room_id, token, delete_local_events
                 )
             logger.info("[purge] complete")
-            self._purges_by_id[purge_id].status = PurgeStatus.STATUS_COMPLETE
+            purge_status.status = PurgeStatus.STATUS_COMPLETE
         except Exception:
             f = Failure()
             logger.error(
                 "[purge] failed", exc_info=(f.type, f.value, f.getTracebackObject())
             )
-            self._purges_by_id[purge_id].status = PurgeStatus.STATUS_FAILED
+            purge_status.status = PurgeStatus.STATUS_FAILED
         finally:
             self._purges_in_progress_by_room.discard(room_id)
 
-            # remove the purge from the list 24 hours after it completes
-            def clear_purge():
-                del self._purges_by_id[purge_id]
-
-            self.hs.get_reactor().callLater(24 * 3600, clear_purge)
+            # only start expiring the purge once it has completed, so that its
+            # status can be looked up for as long as it is running.
+            del self._purges_by_id[purge_id]
+            self._completed_purges_by_id[purge_id] = purge_status
 
     def get_purge_status(self, purge_id):
         """Get the current status of an active purge
@@ -262,11 +307,14 @@ class PaginationHandler(object):
         Returns:
             PurgeStatus|None
         """
-        return self._purges_by_id.get(purge_id)
+        purge_status = self._purges_by_id.get(purge_id)
+        if purge_status is None:
+            purge_status = self._completed_purges_by_id.get(purge_id)
+        return purge_status
 
     async def purge_room(self, room_id):
         """Purge the given room from the database"""
-        with (await self.pagination_lock.write(room_id)):
+        async with self.pagination_lock.write(room_id):
             # check we know about the room
             await self.store.get_room_version(room_id)
 
@@ -302,52 +350,81 @@ class PaginationHandler(object):
         """
         user_id = requester.user.to_string()
 
-        if pagin_config.from_token:
-            room_token = pagin_config.from_token.room_key
-        else:
+        if not pagin_config.from_token:
             pagin_config.from_token = (
                 await self.hs.get_event_sources().get_current_token_for_pagination()
             )
-            room_token = pagin_config.from_token.room_key
 
-        room_token = RoomStreamToken.parse(room_token)
+        room_key = pagin_config.from_token.room_key
+        room_token = RoomStreamToken.parse(room_key)
 
-        pagin_config.from_token = pagin_config.from_token.copy_and_replace(
-            "room_key", str(room_token)
-        )
+        # Only rebuild the token if the room key wasn't already in canonical form.
+        canonical_room_key = str(room_token)
+        if canonical_room_key != room_key:
+            pagin_config.from_token = pagin_config.from_token.copy_and_replace(
+                "room_key", canonical_room_key
+            )
 
         source_config = pagin_config.get_source_config("room")
 
-        with (await self.pagination_lock.read(room_id)):
-            (
-                membership,
-                member_event_id,
-            ) = await self.auth.check_in_room_or_world_readable(room_id, user_id)
-
-            if source_config.direction == "b":
+        async with self.pagination_lock.read(room_id):
+            if source_config.direction == "b" and not room_token.topological:
                 # if we're going backwards, we might need to backfill. This
-                # requires that we have a topo token.
-                if room_token.topological:
-                    max_topo = room_token.topological
-                else:
-                    max_topo = await self.store.get_max_topological_token(
-                        room_id, room_token.stream
+                # requires that we have a topo token, which we can look up while
+                # we check that the user is allowed to see the room.
+                (membership, member_event_id), max_topo = await make_deferred_yieldable(
+                    defer.gatherResults(
+                        [
+                            run_in_background(
+                                self.auth.check_in_room_or_world_readable,
+                                room_id,
+                                user_id,
+                            ),
+                            run_in_background(
+                                self.store.get_max_topological_token,
+                                room_id,
+                                room_token.stream,
+                            ),
+                        ],
+                        consumeErrors=True,
                     )
+                ).addErrback(unwrapFirstError)
+            else:
+                (
+                    membership,
+                    member_event_id,
+                ) = await self.auth.check_in_room_or_world_readable(room_id, user_id)
+                max_topo = room_token.topological
+
+            if source_config.direction == "b":
+                federation_handler = self.hs.get_handlers().federation_handler
 
                 if membership == Membership.LEAVE:
                     # If they have left the room then clamp the token to be before
                     # they left the room, to save the effort of loading from the
-                    # database.
-                    leave_token = await self.store.get_topological_token_for_event(
-                        member_event_id
-                    )
+                    # database. We look that up while we backfill, since backfilling
+                    # doesn't depend on it.
+                    _, leave_token = await make_deferred_yieldable(
+                        defer.gatherResults(
+                            [
+                                run_in_background(
+                                    federation_handler.maybe_backfill,
+                                    room_id,
+                                    max_topo,
+                                ),
+                                run_in_background(
+                                    self.store.get_topological_token_for_member_event,
+                                    member_event_id,
+                                ),
+                            ],
+                            consumeErrors=True,
+                        )
+                    ).addErrback(unwrapFirstError)
                     leave_token = RoomStreamToken.parse(leave_token)
                     if leave_token.topological < max_topo:
                         source_config.from_key = str(leave_token)
-
-                await self.hs.get_handlers().federation_handler.maybe_backfill(
-                    room_id, max_topo
-                )
+                else:
+                    await federation_handler.maybe_backfill(room_id, max_topo)
 
             events, next_key = await self.store.paginate_room_events(
                 room_id=room_id,
@@ -360,53 +437,97 @@ class PaginationHandler(object):
 
             next_token = pagin_config.from_token.copy_and_replace("room_key", next_key)
 
+        # Note that we always need to run the events through
+        # filter_events_for_client, even if the room is currently world readable:
+        # visibility is checked against the state at each event rather than the
+        # room's current state, and the filtering also drops events from ignored
+        # users, applies the room's retention policy and prunes events sent by
+        # erased users.
+        state_ids = None
         if events:
-            if event_filter:
-                events = event_filter.filter(events)
+            if event_filter and event_filter.lazy_load_members():
+                # TODO: remove redundant members
 
-            events = await filter_events_for_client(
-                self.storage, user_id, events, is_peeking=(member_event_id is None)
-            )
+                # FIXME: we also care about invite targets etc.
+                state_filter = StateFilter(
+                    types={EventTypes.Member: {event.sender for event in events}}
+                )
+                first_event_id = events[0].event_id
+
+                # Look up the membership state of the chunk's senders while we
+                # work out which events the user is allowed to see. This is based
+                # on the unfiltered events, so gets trimmed down below.
+                events, state_ids = await make_deferred_yieldable(
+                    defer.gatherResults(
+                        [
+                            run_in_background(
+                                filter_events_for_client,
+                                self.storage,
+                                user_id,
+                                events,
+                                is_peeking=(member_event_id is None),
+                            ),
+                            run_in_background(
+                                self.state_store.get_state_ids_for_event,
+                                first_event_id,
+                                state_filter=state_filter,
+                            ),
+                        ],
+                        consumeErrors=True,
+                    )
+                ).addErrback(unwrapFirstError)
+            else:
+                events = await filter_events_for_client(
+                    self.storage, user_id, events, is_peeking=(member_event_id is None)
+                )
 
         if not events:
-            return {
-                "chunk": [],
-                "start": pagin_config.from_token.to_string(),
-                "end": next_token.to_string(),
-            }
+            start = pagin_config.from_token.to_string()
+            if next_key == pagin_config.from_token.room_key:
+                # We didn't move, so the end token is the same as the start one.
+                end = start
+            else:
+                end = next_token.to_string()
 
-        state = None
-        if event_filter and event_filter.lazy_load_members() and len(events) > 0:
-            # TODO: remove redundant members
+            return {"chunk": [], "start": start, "end": end}
 
-            # FIXME: we also care about invite targets etc.
-            state_filter = StateFilter.from_types(
-                (EventTypes.Member, event.sender) for event in events
-            )
+        state = None
+        if state_ids is not None:
+            if events[0].event_id != first_event_id:
+                # The first event got filtered out, so we looked up the state at
+                # the wrong point in the room.
+                state_ids = await self.state_store.get_state_ids_for_event(
+                    events[0].event_id, state_filter=state_filter
+                )
 
-            state_ids = await self.state_store.get_state_ids_for_event(
-                events[0].event_id, state_filter=state_filter
-            )
+            # Only return the membership of senders of events the user can see.
+            senders = {event.sender for event in events}
+            state_ids = {
+                key: event_id
+                for key, event_id in state_ids.items()
+                if key[1] in senders
+            }
 
             if state_ids:
-                state = await self.store.get_events(list(state_ids.values()))
+                state = await self.store.get_events(state_ids.values())
                 state = state.values()
 
         time_now = self.clock.time_msec()
 
+        # Serialize the chunk and its state in one go, so that they all get
+        # serialized concurrently.
+        state = list(state) if state else []
+        serialized_events = await self._event_serializer.serialize_events(
+            itertools.chain(events, state), time_now, as_client_event=as_client_event
+        )
+
         chunk = {
-            "chunk": (
-                await self._event_serializer.serialize_events(
-                    events, time_now, as_client_event=as_client_event
-                )
-            ),
+            "chunk": serialized_events[: len(events)],
             "start": pagin_config.from_token.to_string(),
             "end": next_token.to_string(),
         }
 
         if state:
-            chunk["state"] = await self._event_serializer.serialize_events(
-                state, time_now, as_client_event=as_client_event
-            )
+            chunk["state"] = serialized_events[len(events) :]
 
         return chunk
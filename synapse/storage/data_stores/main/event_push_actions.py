@@ -532,6 +532,29 @@ class EventPushActionsWorkerStore(SQLBaseStore):
             ts,
         )
 
+    def find_first_stream_orderings_after_ts(self, timestamps):
+        """Gets the stream orderings corresponding to a collection of timestamps.
+
+        This is equivalent to calling `find_first_stream_ordering_after_ts` for
+        each timestamp, but does all of the lookups in a single transaction.
+
+        Args:
+            timestamps (Iterable[int]): timestamps in millis
+
+        Returns:
+            Deferred[dict[int, int]]: map from each timestamp to the stream
+                ordering of the first event received on/after that timestamp
+        """
+        timestamps = set(timestamps)
+
+        def _f(txn):
+            return {
+                ts: self._find_first_stream_ordering_after_ts_txn(txn, ts)
+                for ts in timestamps
+            }
+
+        return self.db.runInteraction("find_first_stream_orderings_after_ts", _f)
+
     @staticmethod
     def _find_first_stream_ordering_after_ts_txn(txn, ts):
         """
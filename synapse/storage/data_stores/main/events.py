@@ -1667,6 +1667,18 @@ class EventsStore(
 
         state_groups = [row[0] for row in txn]
 
+        # Invalidate the cached positions of the room's current membership events,
+        # which are the only events `get_topological_token_for_member_event` is
+        # called with.
+        txn.execute(
+            "SELECT event_id FROM current_state_events WHERE room_id = ? AND type = ?",
+            (room_id, EventTypes.Member),
+        )
+        for (event_id,) in txn.fetchall():
+            self._invalidate_cache_and_stream(
+                txn, self.get_topological_token_for_member_event, (event_id,)
+            )
+
         # Now we delete tables which lack an index on room_id but have one on event_id
         for table in (
             "event_auth",
@@ -37,11 +37,10 @@ what sort order was used:
 """
 
 import abc
+import itertools
 import logging
 from collections import namedtuple
 
-from six.moves import range
-
 from twisted.internet import defer
 
 from synapse.logging.context import make_deferred_yieldable, run_in_background
@@ -50,6 +49,7 @@ from synapse.storage.data_stores.main.events_worker import EventsWorkerStore
 from synapse.storage.database import Database
 from synapse.storage.engines import PostgresEngine
 from synapse.types import RoomStreamToken
+from synapse.util.caches.descriptors import cached
 from synapse.util.caches.stream_change_cache import StreamChangeCache
 
 logger = logging.getLogger(__name__)
@@ -244,6 +244,44 @@ def filter_to_clause(event_filter):
     return " AND ".join(clauses), args
 
 
+def _filter_needs_event_check(event_filter):
+    """Whether the given filter has conditions which `filter_to_clause` can't
+    express in SQL, and so which need checking against the fetched events.
+
+    Args:
+        event_filter (Filter|None)
+
+    Returns:
+        bool
+    """
+    if not event_filter:
+        return False
+
+    # `filter_to_clause` ignores empty lists of allowed values, whereas they
+    # match nothing when checked against an event.
+    for allowed_values in (
+        event_filter.types,
+        event_filter.senders,
+        event_filter.rooms,
+    ):
+        if allowed_values is not None and not allowed_values:
+            return True
+
+    # Labels and URLs are matched on columns which keep their values when an
+    # event is redacted, whereas checking the event looks at its (redacted)
+    # content. See also the comment on the "labels" filter in `filter_to_clause`.
+    if (
+        event_filter.labels is not None
+        or event_filter.not_labels
+        or event_filter.contains_url is not None
+    ):
+        return True
+
+    # Wildcards in the types are compared literally by the SQL query.
+    types = itertools.chain(event_filter.types or [], event_filter.not_types)
+    return any(typ.endswith("*") for typ in types)
+
+
 class StreamWorkerStore(EventsWorkerStore, SQLBaseStore):
     """This is an abstract base class where subclasses must implement
     `get_room_max_stream_ordering` and `get_room_min_stream_ordering`
@@ -537,19 +575,55 @@ class StreamWorkerStore(EventsWorkerStore, SQLBaseStore):
                 (stream ordering, topological ordering, event_id)
         """
 
+        return self.db.runInteraction(
+            "get_room_event_after_stream_ordering",
+            self._get_room_event_after_stream_ordering_txn,
+            room_id,
+            stream_ordering,
+        )
+
+    def get_room_events_after_stream_orderings(self, room_stream_orderings):
+        """Gets details of the first event in each of the given rooms at or after
+        the matching stream ordering.
+
+        This is equivalent to calling `get_room_event_after_stream_ordering` for
+        each room, but does all of the lookups in a single transaction.
+
+        Args:
+            room_stream_orderings (Iterable[tuple[str, int]]): (room_id,
+                stream_ordering) pairs to look up
+
+        Returns:
+            Deferred[dict[str, (int, int, str)]]: map from room_id to
+                (stream ordering, topological ordering, event_id). Rooms for
+                which no event was found are omitted.
+        """
+        room_stream_orderings = list(room_stream_orderings)
+
         def _f(txn):
-            sql = (
-                "SELECT stream_ordering, topological_ordering, event_id"
-                " FROM events"
-                " WHERE room_id = ? AND stream_ordering >= ?"
-                " AND NOT outlier"
-                " ORDER BY stream_ordering"
-                " LIMIT 1"
-            )
-            txn.execute(sql, (room_id, stream_ordering))
-            return txn.fetchone()
+            results = {}
+            for room_id, stream_ordering in room_stream_orderings:
+                row = self._get_room_event_after_stream_ordering_txn(
+                    txn, room_id, stream_ordering
+                )
+                if row:
+                    results[room_id] = row
+            return results
 
-        return self.db.runInteraction("get_room_event_after_stream_ordering", _f)
+        return self.db.runInteraction("get_room_events_after_stream_orderings", _f)
+
+    @staticmethod
+    def _get_room_event_after_stream_ordering_txn(txn, room_id, stream_ordering):
+        sql = (
+            "SELECT stream_ordering, topological_ordering, event_id"
+            " FROM events"
+            " WHERE room_id = ? AND stream_ordering >= ?"
+            " AND NOT outlier"
+            " ORDER BY stream_ordering"
+            " LIMIT 1"
+        )
+        txn.execute(sql, (room_id, stream_ordering))
+        return txn.fetchone()
 
     @defer.inlineCallbacks
     def get_room_events_max_id(self, room_id=None):
@@ -599,6 +673,25 @@ class StreamWorkerStore(EventsWorkerStore, SQLBaseStore):
             lambda row: "t%d-%d" % (row["topological_ordering"], row["stream_ordering"])
         )
 
+    @cached(max_entries=10000)
+    def get_topological_token_for_member_event(self, event_id):
+        """The stream token for a membership event
+
+        This is a cached version of `get_topological_token_for_event`, for use
+        with membership events only. Those are state events, and so are never
+        removed by purging history; the cache is invalidated when the room is
+        purged.
+
+        Args:
+            event_id(str): The id of the membership event to look up a stream
+                token for.
+        Raises:
+            StoreError if the event wasn't in the database.
+        Returns:
+            A deferred "t%d-%d" topological token.
+        """
+        return self.get_topological_token_for_event(event_id)
+
     def get_max_topological_token(self, room_id, stream_key):
         """Get the max topological token in a room before the given stream
         ordering.
@@ -944,13 +1037,16 @@ class StreamWorkerStore(EventsWorkerStore, SQLBaseStore):
                 paginating forwards or backwards from `from_key`.
             limit (int): The maximum number of events to return.
             event_filter (Filter|None): If provided filters the events to
-                those that match the filter.
+                those that match the filter. As much of the filter as possible
+                is applied by the database query.
 
         Returns:
             tuple[list[FrozenEvent], str]: Returns the results as a list of
             events and a token that points to the end of the result set. If no
             events are returned then the end of the stream has been reached
-            (i.e. there are no events between `from_key` and `to_key`).
+            (i.e. there are no events between `from_key` and `to_key`), but
+            the list may also be empty or shorter than `limit` because of the
+            parts of `event_filter` which couldn't be applied in the database.
         """
 
         from_key = RoomStreamToken.parse(from_key)
@@ -974,6 +1070,9 @@ class StreamWorkerStore(EventsWorkerStore, SQLBaseStore):
 
         self._set_before_and_after(events, rows)
 
+        if _filter_needs_event_check(event_filter):
+            events = event_filter.filter(events)
+
         return (events, token)
 
 
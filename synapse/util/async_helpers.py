@@ -324,11 +324,11 @@ class Linearizer(object):
 
 
 class ReadWriteLock(object):
-    """A deferred style read write lock.
+    """An async read write lock.
 
     Example:
 
-        with (yield read_write_lock.read("test_key")):
+        async with read_write_lock.read("test_key"):
             # do some work
     """
 
@@ -343,6 +343,14 @@ class ReadWriteLock(object):
     # Write: We know its safe to acquire the write lock when both the latest
     # writers and readers have been resolved. The new writer replaces the latest
     # writer.
+    #
+    # The lock is queued for as soon as `read` or `write` is called, rather than
+    # when the returned context manager is entered, so that the ordering of
+    # callers is preserved.
+    #
+    # Each key is locked independently, and the state for a key is dropped once
+    # nothing holds or waits on its lock, so that we don't accumulate an entry
+    # for every key that has ever been locked.
 
     def __init__(self):
         # Latest readers queued
@@ -351,7 +359,6 @@ class ReadWriteLock(object):
         # Latest writer queued
         self.key_to_current_writer = {}  # type: Dict[str, defer.Deferred]
 
-    @defer.inlineCallbacks
     def read(self, key):
         new_defer = defer.Deferred()
 
@@ -360,25 +367,24 @@ class ReadWriteLock(object):
 
         curr_readers.add(new_defer)
 
+        def _release():
+            new_defer.callback(None)
+            readers = self.key_to_current_readers.get(key)
+            if readers is not None:
+                readers.discard(new_defer)
+                if not readers:
+                    del self.key_to_current_readers[key]
+
         # We wait for the latest writer to finish writing. We can safely ignore
         # any existing readers... as they're readers.
-        yield make_deferred_yieldable(curr_writer)
+        return _ReadWriteLockContext(curr_writer, _release)
 
-        @contextmanager
-        def _ctx_manager():
-            try:
-                yield
-            finally:
-                new_defer.callback(None)
-                self.key_to_current_readers.get(key, set()).discard(new_defer)
-
-        return _ctx_manager()
-
-    @defer.inlineCallbacks
     def write(self, key):
         new_defer = defer.Deferred()
 
-        curr_readers = self.key_to_current_readers.get(key, set())
+        # We can clear the list of current readers since the new writer waits
+        # for them to finish.
+        curr_readers = self.key_to_current_readers.pop(key, set())
         curr_writer = self.key_to_current_writer.get(key, None)
 
         # We wait on all latest readers and writer.
@@ -386,23 +392,40 @@ class ReadWriteLock(object):
         if curr_writer:
             to_wait_on.append(curr_writer)
 
-        # We can clear the list of current readers since the new writer waits
-        # for them to finish.
-        curr_readers.clear()
         self.key_to_current_writer[key] = new_defer
 
-        yield make_deferred_yieldable(defer.gatherResults(to_wait_on))
+        def _release():
+            new_defer.callback(None)
+            if self.key_to_current_writer[key] == new_defer:
+                self.key_to_current_writer.pop(key)
 
-        @contextmanager
-        def _ctx_manager():
-            try:
-                yield
-            finally:
-                new_defer.callback(None)
-                if self.key_to_current_writer[key] == new_defer:
-                    self.key_to_current_writer.pop(key)
+        return _ReadWriteLockContext(
+            defer.gatherResults(to_wait_on) if to_wait_on else None, _release
+        )
+
+
+class _ReadWriteLockContext(object):
+    """The async context manager returned by `ReadWriteLock.read` and
+    `ReadWriteLock.write`.
+
+    Args:
+        to_wait_on (Deferred|None): resolves once the lock has been acquired,
+            or None if it is already held.
+        release (callable): called to release the lock.
+    """
+
+    __slots__ = ["_to_wait_on", "_release"]
+
+    def __init__(self, to_wait_on, release):
+        self._to_wait_on = to_wait_on
+        self._release = release
+
+    async def __aenter__(self):
+        if self._to_wait_on is not None:
+            await make_deferred_yieldable(self._to_wait_on)
 
-        return _ctx_manager()
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self._release()
 
 
 def _cancelled_to_timed_out_error(value, timeout):
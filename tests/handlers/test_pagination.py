@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import defer
+
+from synapse.handlers.pagination import PurgeStatus
+from synapse.rest.client.v1 import room
+
+from tests import unittest
+
+
+class PurgeStatusTestCase(unittest.HomeserverTestCase):
+
+    user_id = "@red:server"
+    servlets = [room.register_servlets]
+
+    def make_homeserver(self, reactor, clock):
+        hs = self.setup_test_homeserver("server", http_client=None)
+        return hs
+
+    def prepare(self, reactor, clock, hs):
+        self.pagination_handler = hs.get_pagination_handler()
+        self.room_id = self.helper.create_room_as(self.user_id)
+
+    def _hold_lock(self, lock_ctx):
+        """Starts a task which holds the given lock until told to release it.
+
+        Returns:
+            Deferred: a deferred which should be resolved to release the lock.
+        """
+        release_d = defer.Deferred()
+
+        async def action():
+            async with lock_ctx:
+                await release_d
+
+        defer.ensureDeferred(action())
+        return release_d
+
+    def test_purge_status_kept_while_purge_running(self):
+        """Tests that the status of a purge can be looked up for as long as it is
+        running, and for 24 hours after it completes.
+        """
+        event_id = self.helper.send(self.room_id, "message 1")["event_id"]
+        token = self.get_success(
+            self.hs.get_datastore().get_topological_token_for_event(event_id)
+        )
+
+        # Hold a read lock on the room so that the purge can't complete.
+        release_d = self._hold_lock(
+            self.pagination_handler.pagination_lock.read(self.room_id)
+        )
+
+        purge_id = self.pagination_handler.start_purge_history(self.room_id, token)
+
+        self.reactor.advance(48 * 3600)
+        purge_status = self.pagination_handler.get_purge_status(purge_id)
+        self.assertEqual(purge_status.status, PurgeStatus.STATUS_ACTIVE)
+
+        release_d.callback(None)
+        self.pump()
+        purge_status = self.pagination_handler.get_purge_status(purge_id)
+        self.assertEqual(purge_status.status, PurgeStatus.STATUS_COMPLETE)
+
+        self.reactor.advance(12 * 3600)
+        self.assertIsNotNone(self.pagination_handler.get_purge_status(purge_id))
+
+        self.reactor.advance(48 * 3600)
+        self.assertIsNone(self.pagination_handler.get_purge_status(purge_id))
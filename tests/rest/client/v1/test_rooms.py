@@ -888,6 +888,99 @@ class RoomMessageListTestCase(RoomBase):
         chunk = channel.json_body["chunk"]
         self.assertEqual(len(chunk), 0, [event["content"] for event in chunk])
 
+    def test_room_messages_filter_wildcard_not_types(self):
+        """Tests that wildcards in a /messages filter's "not_types" are honoured."""
+        self.helper.send(self.room_id, "message 1")
+        token = self.helper.send_state(
+            self.room_id, EventTypes.Topic, {"topic": "a topic"}, tok=None
+        )["event_id"]
+        token = self.get_success(
+            self.hs.get_datastore().get_topological_token_for_event(token)
+        )
+
+        request, channel = self.make_request(
+            "GET",
+            "/rooms/%s/messages?access_token=x&from=%s&dir=b&filter=%s"
+            % (self.room_id, token, json.dumps({"not_types": ["m.room.*"]})),
+        )
+        self.render(request)
+        self.assertEqual(channel.code, 200, channel.json_body)
+
+        chunk = channel.json_body["chunk"]
+        self.assertEqual([event["type"] for event in chunk], [], chunk)
+
+    def test_room_messages_filter_empty_lists(self):
+        """Tests that empty lists of allowed values in a /messages filter match no
+        event.
+        """
+        self.helper.send(self.room_id, "message 1")
+
+        for event_filter in (
+            {"types": []},
+            {"senders": []},
+            {"rooms": []},
+            {"org.matrix.labels": []},
+        ):
+            request, channel = self.make_request(
+                "GET",
+                "/rooms/%s/messages?access_token=x&dir=b&filter=%s"
+                % (self.room_id, json.dumps(event_filter)),
+            )
+            self.render(request)
+            self.assertEqual(channel.code, 200, channel.json_body)
+
+            chunk = channel.json_body["chunk"]
+            self.assertEqual(chunk, [], event_filter)
+
+    def test_room_messages_after_leaving(self):
+        """Tests that a user who left a room can still paginate through it."""
+        self.helper.send(self.room_id, "message 1")
+        self.helper.leave(self.room_id, self.user_id)
+
+        request, channel = self.make_request(
+            "GET",
+            "/rooms/%s/messages?access_token=x&dir=b&filter=%s"
+            % (self.room_id, json.dumps({"types": [EventTypes.Message]})),
+        )
+        self.render(request)
+        self.assertEqual(channel.code, 200, channel.json_body)
+
+        chunk = channel.json_body["chunk"]
+        self.assertEqual(
+            [event["content"]["body"] for event in chunk], ["message 1"], chunk
+        )
+
+    def test_room_messages_lazy_load_members(self):
+        """Tests that /messages returns the membership of the chunk's senders when
+        lazy-loading members.
+        """
+        self.helper.send(self.room_id, "message 1")
+        token = self.helper.send(self.room_id, "message 2")["event_id"]
+        token = self.get_success(
+            self.hs.get_datastore().get_topological_token_for_event(token)
+        )
+
+        request, channel = self.make_request(
+            "GET",
+            "/rooms/%s/messages?access_token=x&from=%s&dir=b&filter=%s"
+            % (
+                self.room_id,
+                token,
+                json.dumps({"types": [EventTypes.Message], "lazy_load_members": True}),
+            ),
+        )
+        self.render(request)
+        self.assertEqual(channel.code, 200, channel.json_body)
+
+        chunk = channel.json_body["chunk"]
+        self.assertEqual(len(chunk), 2, [event["content"] for event in chunk])
+
+        state = channel.json_body["state"]
+        self.assertEqual(
+            [(event["type"], event["state_key"]) for event in state],
+            [(EventTypes.Member, self.user_id)],
+        )
+
 
 class RoomSearchTestCase(unittest.HomeserverTestCase):
     servlets = [
@@ -196,3 +196,28 @@ class EventPushActionsStoreTestCase(tests.unittest.TestCase):
         yield add_event(0, 5)
         r = yield self.store.find_first_stream_ordering_after_ts(1)
         self.assertEqual(r, 0)
+
+    @defer.inlineCallbacks
+    def test_find_first_stream_orderings_after_ts(self):
+        for (stream_ordering, ts) in ((2, 10), (3, 110), (4, 120), (5, 120)):
+            yield self.store.db.simple_insert(
+                "events",
+                {
+                    "stream_ordering": stream_ordering,
+                    "received_ts": ts,
+                    "event_id": "event%i" % stream_ordering,
+                    "type": "",
+                    "room_id": "",
+                    "content": "",
+                    "processed": True,
+                    "outlier": False,
+                    "topological_ordering": 0,
+                    "depth": 0,
+                },
+            )
+
+        r = yield self.store.find_first_stream_orderings_after_ts([9, 110, 120, 120])
+        self.assertEqual(r, {9: 2, 110: 3, 120: 4})
+
+        r = yield self.store.find_first_stream_orderings_after_ts([])
+        self.assertEqual(r, {})
@@ -13,6 +13,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from synapse.api.constants import EventTypes
+from synapse.api.errors import StoreError
 from synapse.rest.client.v1 import room
 
 from tests.unittest import HomeserverTestCase
@@ -105,3 +107,23 @@ class PurgeTests(HomeserverTestCase):
         self.successResultOf(get_second)
         self.successResultOf(get_third)
         self.successResultOf(get_last)
+
+    def test_purge_room_invalidates_member_event_token_cache(self):
+        """
+        Purging a room invalidates the cached topological tokens of its
+        membership events.
+        """
+        store = self.hs.get_datastore()
+
+        state_ids = self.get_success(store.get_current_state_ids(self.room_id))
+        member_event_id = state_ids[(EventTypes.Member, self.user_id)]
+
+        # Get the topological token, which caches it
+        self.get_success(store.get_topological_token_for_member_event(member_event_id))
+
+        self.get_success(store.purge_room(self.room_id))
+
+        # The event's token should no longer be available
+        self.get_failure(
+            store.get_topological_token_for_member_event(member_event_id), StoreError
+        )
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from synapse.rest.client.v1 import room
+
+from tests.unittest import HomeserverTestCase
+
+
+class RoomEventsAfterStreamOrderingsTestCase(HomeserverTestCase):
+
+    user_id = "@red:server"
+    servlets = [room.register_servlets]
+
+    def make_homeserver(self, reactor, clock):
+        hs = self.setup_test_homeserver("server", http_client=None)
+        return hs
+
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+
+    def _get_event(self, event_id):
+        return self.get_success(self.store.get_event(event_id))
+
+    def test_get_room_events_after_stream_orderings(self):
+        room_1 = self.helper.create_room_as(self.user_id)
+        room_2 = self.helper.create_room_as(self.user_id)
+        room_3 = self.helper.create_room_as(self.user_id)
+
+        event_1 = self._get_event(self.helper.send(room_1, body="1")["event_id"])
+        event_2 = self._get_event(self.helper.send(room_2, body="2")["event_id"])
+
+        # Send some more events in room 2 so that it has events after the one we
+        # look up.
+        self.helper.send(room_2, body="3")
+
+        last_ordering = self.store.get_room_max_stream_ordering()
+
+        res = self.get_success(
+            self.store.get_room_events_after_stream_orderings(
+                [
+                    (room_1, event_1.internal_metadata.stream_ordering),
+                    (room_2, event_2.internal_metadata.stream_ordering),
+                    # There's no event in room 3 after the last stream ordering.
+                    (room_3, last_ordering + 1),
+                ]
+            )
+        )
+
+        self.assertEqual(
+            res,
+            {
+                room_1: (
+                    event_1.internal_metadata.stream_ordering,
+                    event_1.depth,
+                    event_1.event_id,
+                ),
+                room_2: (
+                    event_2.internal_metadata.stream_ordering,
+                    event_2.depth,
+                    event_2.event_id,
+                ),
+            },
+        )
+
+        res = self.get_success(self.store.get_room_events_after_stream_orderings([]))
+        self.assertEqual(res, {})
@@ -14,17 +14,37 @@
 # limitations under the License.
 
 
+from twisted.internet import defer
+
 from synapse.util.async_helpers import ReadWriteLock
 
 from tests import unittest
 
 
 class ReadWriteLockTestCase(unittest.TestCase):
+    def _start_reader_or_writer(self, lock_ctx):
+        """Starts a task which holds the given lock until told to release it.
+
+        Returns:
+            tuple[Deferred, Deferred]: a deferred which resolves once the lock
+            has been acquired, and one which should be resolved to release it.
+        """
+        acquired_d = defer.Deferred()
+        release_d = defer.Deferred()
+
+        async def action():
+            async with lock_ctx:
+                acquired_d.callback(None)
+                await release_d
+
+        defer.ensureDeferred(action())
+        return acquired_d, release_d
+
     def _assert_called_before_not_after(self, lst, first_false):
-        for i, d in enumerate(lst[:first_false]):
+        for i, (d, _) in enumerate(lst[:first_false]):
             self.assertTrue(d.called, msg="%d was unexpectedly false" % i)
 
-        for i, d in enumerate(lst[first_false:]):
+        for i, (d, _) in enumerate(lst[first_false:]):
             self.assertFalse(
                 d.called, msg="%d was unexpectedly true" % (i + first_false)
             )
@@ -35,50 +55,81 @@ class ReadWriteLockTestCase(unittest.TestCase):
         key = object()
 
         ds = [
-            rwlock.read(key),  # 0
-            rwlock.read(key),  # 1
-            rwlock.write(key),  # 2
-            rwlock.write(key),  # 3
-            rwlock.read(key),  # 4
-            rwlock.read(key),  # 5
-            rwlock.write(key),  # 6
+            self._start_reader_or_writer(rwlock.read(key)),  # 0
+            self._start_reader_or_writer(rwlock.read(key)),  # 1
+            self._start_reader_or_writer(rwlock.write(key)),  # 2
+            self._start_reader_or_writer(rwlock.write(key)),  # 3
+            self._start_reader_or_writer(rwlock.read(key)),  # 4
+            self._start_reader_or_writer(rwlock.read(key)),  # 5
+            self._start_reader_or_writer(rwlock.write(key)),  # 6
         ]
 
         self._assert_called_before_not_after(ds, 2)
 
-        with ds[0].result:
-            self._assert_called_before_not_after(ds, 2)
+        ds[0][1].callback(None)
         self._assert_called_before_not_after(ds, 2)
 
-        with ds[1].result:
-            self._assert_called_before_not_after(ds, 2)
+        ds[1][1].callback(None)
         self._assert_called_before_not_after(ds, 3)
 
-        with ds[2].result:
-            self._assert_called_before_not_after(ds, 3)
+        ds[2][1].callback(None)
         self._assert_called_before_not_after(ds, 4)
 
-        with ds[3].result:
-            self._assert_called_before_not_after(ds, 4)
+        ds[3][1].callback(None)
         self._assert_called_before_not_after(ds, 6)
 
-        with ds[5].result:
-            self._assert_called_before_not_after(ds, 6)
+        ds[5][1].callback(None)
         self._assert_called_before_not_after(ds, 6)
 
-        with ds[4].result:
-            self._assert_called_before_not_after(ds, 6)
+        ds[4][1].callback(None)
         self._assert_called_before_not_after(ds, 7)
 
-        with ds[6].result:
-            pass
+        ds[6][1].callback(None)
+
+        acquired_d, release_d = self._start_reader_or_writer(rwlock.write(key))
+        self.assertTrue(acquired_d.called)
+        release_d.callback(None)
+
+        acquired_d, release_d = self._start_reader_or_writer(rwlock.read(key))
+        self.assertTrue(acquired_d.called)
+        release_d.callback(None)
+
+    def test_lock_released_on_error(self):
+        rwlock = ReadWriteLock()
+
+        key = object()
+
+        async def fail():
+            async with rwlock.write(key):
+                raise Exception("oops")
+
+        d = defer.ensureDeferred(fail())
+        self.failureResultOf(d, Exception)
+
+        acquired_d, release_d = self._start_reader_or_writer(rwlock.read(key))
+        self.assertTrue(acquired_d.called)
+        release_d.callback(None)
+
+    def test_state_dropped_after_release(self):
+        rwlock = ReadWriteLock()
+
+        key = object()
+
+        ds = [
+            self._start_reader_or_writer(rwlock.read(key)),
+            self._start_reader_or_writer(rwlock.write(key)),
+            self._start_reader_or_writer(rwlock.read(key)),
+        ]
+
+        # locking one key should not block another
+        other_acquired_d, other_release_d = self._start_reader_or_writer(
+            rwlock.write(object())
+        )
+        self.assertTrue(other_acquired_d.called)
+        other_release_d.callback(None)
 
-        d = rwlock.write(key)
-        self.assertTrue(d.called)
-        with d.result:
-            pass
+        for _, release_d in ds:
+            release_d.callback(None)
 
-        d = rwlock.read(key)
-        self.assertTrue(d.called)
-        with d.result:
-            pass
+        self.assertEqual(rwlock.key_to_current_readers, {})
+        self.assertEqual(rwlock.key_to_current_writer, {})